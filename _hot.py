@@ -0,0 +1,30 @@
+"""Funkcje z gorącej ścieżki /classify.
+
+Moduł jest zwykłym Pythonem (działa bez kompilacji), ale w obrazie Dockera kompilujemy go Cythonem
+(setup.py) - adnotacje typów pozwalają Cythonowi wyspecjalizować kod.
+"""
+import string
+from typing import Dict, Optional
+
+# Dozwolone znaki identyfikatorów; sprawdzenie przez frozenset.issuperset omija silnik regex
+SAFE_CONTAINER_ID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+SAFE_SESSION_ID_CHARS = SAFE_CONTAINER_ID_CHARS | {"."}  # sessionId dopuszcza dodatkowo kropkę
+
+def is_safe_id(value: str, allowed_chars: frozenset) -> bool:
+    """Sprawdza, czy niepusty identyfikator składa się wyłącznie z dozwolonych znaków."""
+    return bool(value) and allowed_chars.issuperset(value)
+
+def get_history_key(container_id: str, session_id: Optional[str]) -> str:
+    """Generuje klucz do przechowywania historii, bazując na containerId i opcjonalnym sessionId."""
+    if session_id and SAFE_SESSION_ID_CHARS.issuperset(session_id):
+        return f"{container_id}:{session_id}"
+    return container_id  # Fallback na stary format, jeśli sessionId nie podany lub niepoprawny
+
+def resolve_event_threshold(event_by_name: Dict[str, object], event_name: Optional[str], default_threshold: float) -> float:
+    """Zwraca próg sklasyfikowanego eventu lub domyślny, jeśli event go nie definiuje."""
+    if event_name is None:
+        return default_threshold
+    event = event_by_name.get(event_name)
+    if event is not None and event.threshold is not None:
+        return event.threshold
+    return default_threshold
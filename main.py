@@ -1,19 +1,33 @@
-import json
+import asyncio
+import functools
+import hashlib
 import logging
-import re
+import orjson
 import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Literal, Dict, List, Any, Optional, Tuple
+from typing import Annotated, Literal, Dict, List, Any, NamedTuple, Optional, Tuple
 from urllib.parse import urlparse
+import httpx
+import redis.asyncio as aioredis
+import tiktoken
 from fastapi import FastAPI, HTTPException, Request, Header
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+import msgspec
+from pydantic import BaseModel
 from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 from langsmith.wrappers import wrap_openai
 from google.cloud import secretmanager
 from google.api_core.exceptions import NotFound
+from _hot import (
+    SAFE_CONTAINER_ID_CHARS,
+    get_history_key,
+    is_safe_id,
+    resolve_event_threshold,
+)
 
 # --- Wczytaj zmienne środowiskowe z pliku .env (dla lokalnego dev) ---
 load_dotenv()
@@ -32,13 +46,13 @@ def get_secret(project_id: str, secret_id: str, version_id: str = "latest") -> s
         name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
         response = client.access_secret_version(request={"name": name})
         payload = response.payload.data.decode("UTF-8")
-        logger.info(f"Successfully retrieved secret: {secret_id}")
+        logger.info("Successfully retrieved secret: %s", secret_id)
         return payload
     except NotFound:
-        logger.error(f"Secret not found: {secret_id} in project {project_id}")
+        logger.error("Secret not found: %s in project %s", secret_id, project_id)
         return None
     except Exception as e:
-        logger.error(f"Error retrieving secret {secret_id}: {e}", exc_info=True)
+        logger.error("Error retrieving secret %s: %s", secret_id, e, exc_info=True)
         return None
 # ----------------------------------------------------------------------
 
@@ -53,8 +67,12 @@ langsmith_api_key = None
 if IS_GCP_ENVIRONMENT:
     logger.info("Detected GCP environment. Attempting to load secrets from Secret Manager.")
     if GCP_PROJECT_ID:
-        openai_api_key = get_secret(GCP_PROJECT_ID, "openai-api-key")
-        langsmith_api_key = get_secret(GCP_PROJECT_ID, "langsmith-api-key")
+        # Oba sekrety pobieramy równolegle (każdy to osobny, blokujący round-trip do Secret Manager)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            openai_key_future = executor.submit(get_secret, GCP_PROJECT_ID, "openai-api-key")
+            langsmith_key_future = executor.submit(get_secret, GCP_PROJECT_ID, "langsmith-api-key")
+            openai_api_key = openai_key_future.result()
+            langsmith_api_key = langsmith_key_future.result()
     else:
         logger.error("Running in GCP, but GOOGLE_CLOUD_PROJECT env var not set. Cannot fetch secrets.")
 else:
@@ -82,11 +100,23 @@ if langsmith_tracing_enabled and not langsmith_api_key:
 # --------------------------------------------------------------------------
 
 # --- Klient OpenAI (opcjonalnie owinięty przez LangSmith) --- 
-# Używa kluczy wczytanych powyżej
-raw_aclient = AsyncOpenAI(api_key=openai_api_key)
+# Używa kluczy wczytanych powyżej. Własny pool httpx (HTTP/2, większy keepalive) zamiast domyślnego,
+# żeby przy burstach ruchu nie blokować się na limicie połączeń.
+OPENAI_TIMEOUT = httpx.Timeout(15.0, connect=3.0)
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=500, max_keepalive_connections=200),
+    timeout=OPENAI_TIMEOUT,
+)
+raw_aclient = AsyncOpenAI(
+    api_key=openai_api_key,
+    http_client=openai_http_client,
+    timeout=OPENAI_TIMEOUT, # SDK nadpisuje timeout klienta httpx własnym, więc ustawiamy go też tutaj
+    max_retries=2,
+)
 
 if langsmith_tracing_enabled and langsmith_api_key: # Sprawdź, czy klucz Langsmith faktycznie jest
-    logger.info(f"LangSmith tracing enabled. Wrapping OpenAI client. Project: {langsmith_project}")
+    logger.info("LangSmith tracing enabled. Wrapping OpenAI client. Project: %s", langsmith_project)
     os.environ["LANGCHAIN_TRACING_V2"] = "true"
     os.environ["LANGCHAIN_API_KEY"] = langsmith_api_key
     os.environ["LANGCHAIN_PROJECT"] = langsmith_project
@@ -99,6 +129,25 @@ else:
     aclient = raw_aclient 
 
 OPENAI_MODEL = "gpt-3.5-turbo"
+# JSON mode + logit_bias: odpowiedź to krótki obiekt {"event": ...}, więc limit tokenów liczymy z długości nazw eventów
+EVENT_TOKEN_LOGIT_BIAS = 4
+# {"event": "…"} bez samej nazwy eventu to ~6 tokenów; zapas na spacje/nowe linie, które model dokleja w JSON mode.
+# Ucięta odpowiedź (finish_reason == "length") nie jest poprawnym JSON-em, więc lepiej przeszacować.
+ANSWER_JSON_OVERHEAD_TOKENS = 16
+# Odpowiedź batchowa: narzut {"id": N, ...} na każdą wiadomość oraz obudowa {"results": [...]}
+BATCH_ANSWER_ITEM_OVERHEAD_TOKENS = 8
+BATCH_ANSWER_JSON_OVERHEAD_TOKENS = 8
+DEFAULT_ANSWER_MAX_TOKENS = 50 # gdy tokenizer jest niedostępny
+# Stałe argumenty chat.completions.create współdzielone przez wszystkie wywołania (tylko do odczytu).
+# Wiadomość z promptem budujemy za każdym razem od nowa - SDK może ją ponownie serializować przy retry,
+# więc współdzielony, mutowany dict mógłby wysłać prompt innego, równoległego żądania.
+OPENAI_CHAT_BASE_KWARGS: Dict[str, Any] = {
+    "model": OPENAI_MODEL,
+    "temperature": 0,
+    "response_format": {"type": "json_object"},
+}
+# Budżet tokenów na listę eventów w prompcie (per nadawca); przykłady ponad budżet są pomijane. 0 = bez limitu
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "800"))
 # ---------------------------------------------------------
 
 app = FastAPI(
@@ -119,7 +168,7 @@ app.add_middleware(
     allow_methods=["GET", "POST", "OPTIONS"],
     allow_headers=["*"],
 )
-logger.info(f"CORS Middleware enabled. Allowed origins: {origins}")
+logger.info("CORS Middleware enabled. Allowed origins: %s", origins)
 # ---------------------------
 
 # --- Config Paths ---
@@ -129,26 +178,44 @@ SNIPPETS_DIR = Path("snippets")
 # --- Mount Static Files Directory ---
 if SNIPPETS_DIR.is_dir():
     app.mount("/snippets", StaticFiles(directory=SNIPPETS_DIR), name="snippets")
-    logger.info(f"Mounted static files directory: {SNIPPETS_DIR} at /snippets")
+    logger.info("Mounted static files directory: %s at /snippets", SNIPPETS_DIR)
 else:
-    logger.warning(f"Snippets directory {SNIPPETS_DIR} not found. Client library will not be served.")
+    logger.warning("Snippets directory %s not found. Client library will not be served.", SNIPPETS_DIR)
 # ---------------------------------
 
 # --- Data Models ---
 
-class Event(BaseModel):
+# Modele configu klienta (czytane z dysku) to msgspec.Struct - dekodowane wprost z bajtów JSON,
+# bez pętli walidatorów Pydantic. Modele API zostają w Pydanticu (FastAPI / OpenAPI).
+
+class Event(msgspec.Struct, frozen=True, kw_only=True):
     name: str
     description: str
-    examples: list[str]
-    threshold: Optional[float] = Field(None, ge=0.0, le=1.0)
+    examples: tuple[str, ...]
+    threshold: Optional[Annotated[float, msgspec.Meta(ge=0.0, le=1.0)]] = None
     sender: Literal["human", "ai"]
 
-class ClientSettings(BaseModel):
-    allowed_domains: List[str] = []
+class ClientSettings(msgspec.Struct, frozen=True, kw_only=True):
+    allowed_domains: tuple[str, ...] = ()
 
-class ClientConfig(BaseModel):
+class ClientConfig(msgspec.Struct, frozen=True, kw_only=True):
     events: List[Event]
     settings: ClientSettings
+    # Prekomputowane przy ładowaniu configu, per nadawca ('human' / 'ai')
+    events_blocks: Dict[str, str] = msgspec.field(default_factory=dict)
+    prompt_prefixes: Dict[str, str] = msgspec.field(default_factory=dict)
+    sender_event_names: Dict[str, frozenset[str]] = msgspec.field(default_factory=dict)
+    logit_biases: Dict[str, Dict[str, int]] = msgspec.field(default_factory=dict)
+    answer_max_tokens: Dict[str, int] = msgspec.field(default_factory=dict)
+    event_by_name: Dict[str, Event] = msgspec.field(default_factory=dict)
+    # Znormalizowane (lowercase) allowed_domains - urlparse().hostname też zwraca lowercase
+    allowed_domains_set: frozenset[str] = frozenset()
+
+# Lista eventów dekodowana jest do surowych elementów, żeby niepoprawny event pominąć zamiast odrzucać cały plik
+events_list_decoder = msgspec.json.Decoder(List[msgspec.Raw])
+# strict=False zachowuje luźną koercję typów dawnych modeli Pydantic (np. "threshold": "0.5")
+event_decoder = msgspec.json.Decoder(Event, strict=False)
+settings_decoder = msgspec.json.Decoder(ClientSettings, strict=False)
 
 class ClassifyRequest(BaseModel):
     text: str
@@ -171,98 +238,434 @@ class PushResponse(BaseModel):
     status: str
     event_data: PushRequest
 
+class HealthResponse(BaseModel):
+    status: str
+    openai_model_status: str
+    langsmith_tracing_status: str
+    langsmith_project: str | None
+
+class PendingClassification(NamedTuple):
+    """Klasyfikacja oczekująca w kolejce micro-batchingu."""
+    container_id: str
+    sender: Literal["human", "ai"]
+    prompt_prefix: str
+    events_block: str
+    message_block: str
+    system_prompt: str
+    allowed_event_names: frozenset[str]
+    logit_bias: Dict[str, int]
+    max_tokens: int
+
+class LRUCache(OrderedDict):
+    """Słownik o ograniczonej pojemności - usuwa najdawniej używane wpisy (LRU)."""
+
+    def __init__(self, capacity: int):
+        super().__init__()
+        self.capacity = capacity
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        # OrderedDict.get nie przechodzi przez __getitem__, więc odświeżamy kolejność jawnie
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.capacity:
+            self.popitem(last=False)
+
 # --- Global Variables / State ---
-push_log: list[PushRequest] = []
-client_config_cache: Dict[str, ClientConfig] = {}
-# Zmodyfikowano strukturę historii wiadomości, aby przechowywać per containerId+sessionId
-message_history: Dict[str, Tuple[str, Literal['human', 'ai']]] = {}
+MESSAGE_HISTORY_MAX = int(os.getenv("MESSAGE_HISTORY_MAX", "50000"))
+CLIENT_CONFIG_CACHE_MAX = int(os.getenv("CLIENT_CONFIG_CACHE_MAX", "2048"))
+PUSH_LOG_MAX = int(os.getenv("PUSH_LOG_MAX", "10000"))
+
+# Ostatnie PUSH_LOG_MAX pushy (starsze wypadają automatycznie); docelowo zapis do zewnętrznego sinka
+push_log: deque[PushRequest] = deque(maxlen=PUSH_LOG_MAX)
+# Cache configów: containerId -> (config, mtime_ns events.json, mtime_ns settings.json), ograniczony LRU
+client_config_cache: LRUCache = LRUCache(CLIENT_CONFIG_CACHE_MAX)
+# Micro-batching klasyfikacji: kolejka i worker startowane w startup_event
+CLASSIFY_BATCH_MAX = int(os.getenv("CLASSIFY_BATCH_MAX", "8"))
+CLASSIFY_BATCH_WAIT_MS = int(os.getenv("CLASSIFY_BATCH_WAIT_MS", "25"))
+classification_queue: Optional[asyncio.Queue] = None
+classification_batch_worker_task: Optional[asyncio.Task] = None
+classification_batch_tasks: set[asyncio.Task] = set()
+# Trwające wywołania OpenAI, kluczowane containerId, nadawcą i hashem promptu (coalescing identycznych zapytań)
+inflight_classifications: Dict[str, asyncio.Future] = {}
+# Historia wiadomości per containerId+sessionId, ograniczona do MESSAGE_HISTORY_MAX sesji (LRU)
+message_history: LRUCache = LRUCache(MESSAGE_HISTORY_MAX)
+# Przy kilku workerach uvicorna historia musi być współdzielona - wtedy trzymamy ją w Redisie (REDIS_URL)
+REDIS_URL = os.getenv("REDIS_URL")
+MESSAGE_HISTORY_TTL_SECONDS = int(os.getenv("MESSAGE_HISTORY_TTL_SECONDS", "86400"))
+redis_client: Optional[aioredis.Redis] = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+# Tokenizer dla OPENAI_MODEL, wczytywany leniwie przez get_token_encoding
+token_encoding: Optional[tiktoken.Encoding] = None
 
 # --- Helper Functions ---
 
-SAFE_CONTAINER_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]+$")
-SAFE_SESSION_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_\-\.]+$")  # Dodano wzorzec dla sessionId
+# is_safe_id, get_history_key i pozostałe helpery gorącej ścieżki żyją w _hot.py (kompilowanym Cythonem)
 
 def sanitize_container_id(container_id: str) -> str | None:
     """Basic sanitization to prevent path traversal."""
-    if SAFE_CONTAINER_ID_PATTERN.match(container_id):
+    if is_safe_id(container_id, SAFE_CONTAINER_ID_CHARS):
         return container_id
-    logger.warning(f"Invalid containerId format attempted: {container_id}")
+    logger.warning("Invalid containerId format attempted: %s", container_id)
     return None
 
 DEFAULT_THRESHOLD = 0.7
 
-def get_history_key(container_id: str, session_id: Optional[str]) -> str:
-    """Generuje klucz do przechowywania historii, bazując na containerId i opcjonalnym sessionId."""
-    if session_id and SAFE_SESSION_ID_PATTERN.match(session_id):
-        return f"{container_id}:{session_id}"
-    return container_id  # Fallback na stary format, jeśli sessionId nie podany lub niepoprawny
+@functools.lru_cache(maxsize=1024)
+def parse_origin_hostname(origin: str) -> str | None:
+    """Zwraca hostname z nagłówka Origin; cache'owane, bo ruch pochodzi zwykle z kilku originów."""
+    return urlparse(origin).hostname
+
+def build_events_block(sender_events: List[Event]) -> str:
+    """Buduje opis eventów (nazwa, opis, przykłady) używany w promptach."""
+    event_lines = []
+    for event in sender_events:
+        event_lines.append(f"- Nazwa: {event.name}")
+        event_lines.append(f"  Opis: {event.description}")
+        if event.examples:
+            formatted_examples = "\n".join([f"    - {ex}" for ex in event.examples])
+            event_lines.append(f"  Przykłady:\n{formatted_examples}")
+    return "\n".join(event_lines)
+
+def get_token_encoding() -> tiktoken.Encoding | None:
+    """Zwraca (i cache'uje) tokenizer tiktoken dla OPENAI_MODEL; None, jeśli nie da się go wczytać.
+
+    Cache'owany jest tylko udany odczyt - po błędzie kolejne ładowanie configu ponawia próbę.
+    """
+    global token_encoding
+    if token_encoding is not None:
+        return token_encoding
+    try:
+        token_encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+    except Exception as e:
+        logger.warning("Could not load tiktoken encoding for %s: %s. Prompt token budget will not be applied.", OPENAI_MODEL, e)
+        return None
+    return token_encoding
+
+def trim_examples_to_budget(sender_events: List[Event], encoding: tiktoken.Encoding, max_tokens: int) -> List[Event]:
+    """Przycina przykłady eventów tak, by lista eventów zmieściła się w max_tokens tokenach.
+
+    Nazwy i opisy eventów zostają zawsze; przykłady są dokładane zachłannie, kolejno pierwszy przykład
+    każdego eventu, potem drugi itd., więc najpierw odpadają dalsze (mniej ważne) przykłady.
+    """
+    full_tokens = len(encoding.encode(build_events_block(sender_events)))
+    if full_tokens <= max_tokens:
+        return sender_events
+
+    bare_events = [msgspec.structs.replace(event, examples=()) for event in sender_events]
+    used_tokens = len(encoding.encode(build_events_block(bare_events)))
+    examples_header_tokens = len(encoding.encode("\n  Przykłady:"))
+    kept_examples: List[List[str]] = [[] for _ in sender_events]
+    max_examples = max(len(event.examples) for event in sender_events)
+    for example_index in range(max_examples):
+        for event_index, event in enumerate(sender_events):
+            if example_index >= len(event.examples):
+                continue
+            example = event.examples[example_index]
+            cost = len(encoding.encode(f"\n    - {example}"))
+            if not kept_examples[event_index]:
+                cost += examples_header_tokens
+            if used_tokens + cost > max_tokens:
+                continue
+            kept_examples[event_index].append(example)
+            used_tokens += cost
+
+    trimmed_events = [
+        msgspec.structs.replace(event, examples=tuple(examples))
+        for event, examples in zip(sender_events, kept_examples)
+    ]
+    dropped = sum(len(event.examples) for event in sender_events) - sum(len(examples) for examples in kept_examples)
+    logger.info("Events block exceeded %s tokens (%s). Dropped %s example(s), now ~%s tokens.", max_tokens, full_tokens, dropped, used_tokens)
+    return trimmed_events
+
+def build_logit_bias(event_names: frozenset[str], encoding: tiktoken.Encoding) -> Dict[str, int]:
+    """Podbija pierwsze tokeny dozwolonych nazw eventów (logit_bias OpenAI: token id -> bias)."""
+    first_tokens = {encoding.encode(name)[0] for name in event_names if name}
+    return {str(token): EVENT_TOKEN_LOGIT_BIAS for token in sorted(first_tokens)}
+
+def build_answer_max_tokens(event_names: frozenset[str], encoding: tiktoken.Encoding | None) -> int:
+    """Limit tokenów odpowiedzi {"event": "..."} - najdłuższa nazwa eventu + narzut JSON-a."""
+    if encoding is None:
+        return DEFAULT_ANSWER_MAX_TOKENS
+    longest_name_tokens = max(len(encoding.encode(name)) for name in event_names)
+    return longest_name_tokens + ANSWER_JSON_OVERHEAD_TOKENS
+
+def build_prompt_prefix(sender: Literal['human', 'ai'], events_block: str) -> str:
+    """Buduje stałą część promptu (instrukcje + lista eventów) dla danego nadawcy."""
+    prompt_lines = [
+        f"Twoim zadaniem jest sklasyfikowanie wiadomości od '{sender}' na podstawie zdefiniowanych eventów.",
+        'Odpowiedz TYLKO obiektem JSON {"event": "nazwa_eventu"} z eventem, który najlepiej pasuje do OSTATNIEJ wiadomości, lub {"event": null}, jeśli żaden nie pasuje.',
+        "Nie dodawaj żadnych wyjaśnień ani dodatkowego tekstu.",
+        "Użyj poprzedniej wiadomości jako kontekstu, jeśli to pomoże.",
+        "",
+        f"Dostępne eventy dla '{sender}':",
+        events_block,
+        "",
+    ]
+    return "\n".join(prompt_lines)
+
+def build_batch_prompt(sender: Literal['human', 'ai'], events_block: str, message_blocks: List[str]) -> str:
+    """Buduje prompt klasyfikujący kilka wiadomości naraz; model odpowiada obiektem JSON z listą wyników."""
+    prompt_lines = [
+        f"Twoim zadaniem jest sklasyfikowanie KAŻDEJ z poniższych wiadomości od '{sender}' na podstawie zdefiniowanych eventów.",
+        "Każdą wiadomość klasyfikuj niezależnie. Jeśli podano poprzednią wiadomość, użyj jej jako kontekstu.",
+        'Odpowiedz TYLKO obiektem JSON w formacie {"results": [{"id": 1, "event": "nazwa_eventu"}, ...]}, z jednym wynikiem dla każdej wiadomości.',
+        'Jeśli żaden event nie pasuje do wiadomości, użyj "event": null.',
+        "Nie dodawaj żadnych wyjaśnień ani dodatkowego tekstu.",
+        "",
+        f"Dostępne eventy dla '{sender}':",
+        events_block,
+        "",
+    ]
+    for message_id, message_block in enumerate(message_blocks, start=1):
+        prompt_lines.append(f"### Wiadomość {message_id}")
+        prompt_lines.append(message_block)
+        prompt_lines.append("")
+    prompt_lines.append("Klasyfikacja (JSON):")
+    return "\n".join(prompt_lines)
+
+def parse_classify_request(raw_body: bytes) -> ClassifyRequest:
+    """Lekka walidacja ciała /classify i budowa ClassifyRequest bez pełnej walidacji Pydantic."""
+    try:
+        body = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="Request body must be valid JSON.")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=422, detail="Request body must be a JSON object.")
+
+    text = body.get("text")
+    sender = body.get("sender")
+    container_id = body.get("containerId")
+    session_id = body.get("sessionId")
+    if not isinstance(text, str):
+        raise HTTPException(status_code=422, detail="Field 'text' must be a string.")
+    if sender not in ("human", "ai"):
+        raise HTTPException(status_code=422, detail="Field 'sender' must be 'human' or 'ai'.")
+    if not isinstance(container_id, str):
+        raise HTTPException(status_code=422, detail="Field 'containerId' must be a string.")
+    if not is_safe_id(container_id, SAFE_CONTAINER_ID_CHARS):
+        logger.warning("Invalid containerId format attempted: %s", container_id)
+        raise HTTPException(status_code=400, detail=f"Invalid or missing configuration for container ID: {container_id}")
+    if session_id is not None and not isinstance(session_id, str):
+        raise HTTPException(status_code=422, detail="Field 'sessionId' must be a string.")
+
+    return ClassifyRequest.model_construct(
+        text=text,
+        sender=sender,
+        containerId=container_id,
+        sessionId=session_id
+    )
+
+def parse_push_request(raw_body: bytes) -> PushRequest:
+    """Lekka walidacja ciała /push i budowa PushRequest bez pełnej walidacji Pydantic."""
+    try:
+        body = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="Request body must be valid JSON.")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=422, detail="Request body must be a JSON object.")
+
+    event = body.get("event")
+    properties = body.get("properties")
+    sender = body.get("sender")
+    if not isinstance(event, str):
+        raise HTTPException(status_code=422, detail="Field 'event' must be a string.")
+    if not isinstance(properties, dict):
+        raise HTTPException(status_code=422, detail="Field 'properties' must be an object.")
+    if sender not in ("human", "ai"):
+        raise HTTPException(status_code=422, detail="Field 'sender' must be 'human' or 'ai'.")
+
+    return PushRequest.model_construct(event=event, properties=properties, sender=sender)
+
+def get_file_mtime_ns(path: Path) -> int | None:
+    """Zwraca mtime pliku w nanosekundach lub None, jeśli pliku nie ma."""
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+def get_config_mtimes(container_id: str) -> Tuple[int | None, int | None]:
+    """Zwraca mtime plików events.json i settings.json danego kontenera."""
+    client_dir = CONFIG_BASE_DIR / container_id
+    return get_file_mtime_ns(client_dir / "events.json"), get_file_mtime_ns(client_dir / "settings.json")
+
+def get_cached_client_config(container_id: str) -> ClientConfig | None:
+    """Zwraca konfigurację z cache (synchronicznie, bez odczytu plików) lub None, jeśli jej tam nie ma lub pliki się zmieniły.
+
+    Nieaktualny wpis zostaje w cache - load_client_config wraca do niego, jeśli przeładowanie się nie powiedzie.
+    """
+    cached_entry = client_config_cache.get(container_id)
+    if cached_entry is None:
+        return None
+    config, events_mtime_ns, settings_mtime_ns = cached_entry
+    # Tani stat zamiast ponownego parsowania - przeładowujemy tylko, jeśli pliki zmieniły się na dysku
+    if get_config_mtimes(container_id) != (events_mtime_ns, settings_mtime_ns):
+        logger.info("Config files changed on disk for containerId: %s. Reloading.", container_id)
+        return None
+    logger.debug("Using cached config for containerId: %s", container_id)
+    return config
+
+async def get_previous_message(history_key: str) -> Tuple[str, Literal['human', 'ai']] | None:
+    """Zwraca ostatnią wiadomość (tekst, nadawca) dla klucza historii - z Redisa lub lokalnego LRU."""
+    if redis_client is None:
+        return message_history.get(history_key)
+    try:
+        raw_entry = await redis_client.get(f"llmaniac:history:{history_key}")
+    except Exception as e:
+        logger.error("Error reading message history from Redis for key %s: %s", history_key, e)
+        return None
+    if raw_entry is None:
+        return None
+    try:
+        entry = orjson.loads(raw_entry)
+    except orjson.JSONDecodeError as e:
+        logger.warning("Ignoring malformed message history entry in Redis for key %s: %s", history_key, e)
+        return None
+    # Wpis musi mieć dokładnie kształt zapisywany przez save_message: [tekst, nadawca]
+    if not (isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], str) and entry[1] in ("human", "ai")):
+        logger.warning("Ignoring malformed message history entry in Redis for key %s: %r", history_key, entry)
+        return None
+    return entry[0], entry[1]
+
+async def save_message(history_key: str, text: str, sender: Literal['human', 'ai']) -> None:
+    """Zapisuje ostatnią wiadomość dla klucza historii - w Redisie (z TTL) lub lokalnym LRU."""
+    if redis_client is None:
+        message_history[history_key] = (text, sender)
+        return
+    try:
+        await redis_client.set(f"llmaniac:history:{history_key}", orjson.dumps([text, sender]), ex=MESSAGE_HISTORY_TTL_SECONDS)
+    except Exception as e:
+        logger.error("Error writing message history to Redis for key %s: %s", history_key, e)
+
+def keep_previous_client_config(
+    container_id: str,
+    previous_entry: Tuple[ClientConfig, int | None, int | None] | None,
+    events_mtime_ns: int | None,
+    settings_mtime_ns: int | None,
+) -> ClientConfig | None:
+    """Po nieudanym przeładowaniu zostawia w cache ostatni poprawny config.
+
+    Wpis dostaje bieżące mtime plików, żeby uszkodzony plik nie był parsowany przy każdym żądaniu -
+    kolejna próba nastąpi dopiero po następnej zmianie na dysku.
+    """
+    if previous_entry is None:
+        return None
+    logger.warning("Reloading config for %s failed. Keeping the last good config.", container_id)
+    config = previous_entry[0]
+    client_config_cache[container_id] = (config, events_mtime_ns, settings_mtime_ns)
+    return config
 
-def load_client_config(container_id: str) -> ClientConfig | None:
+async def load_client_config(container_id: str) -> ClientConfig | None:
     """Ładuje konfigurację klienta (eventy i ustawienia) z plików."""
 
     sanitized_id = sanitize_container_id(container_id)
     if not sanitized_id:
         return None
 
-    if sanitized_id in client_config_cache:
-        logger.debug(f"Using cached config for containerId: {sanitized_id}")
-        return client_config_cache[sanitized_id]
+    cached_config = get_cached_client_config(sanitized_id)
+    if cached_config is not None:
+        return cached_config
+    # Ostatni poprawny config (jeśli był) - serwujemy go dalej, gdy nowa wersja plików jest uszkodzona
+    previous_entry = client_config_cache.get(sanitized_id)
 
-    logger.info(f"Loading config for containerId: {sanitized_id}")
+    logger.info("Loading config for containerId: %s", sanitized_id)
     client_dir = CONFIG_BASE_DIR / sanitized_id
     events_path = client_dir / "events.json"
     settings_path = client_dir / "settings.json"
 
     if not client_dir.is_dir():
-        logger.error(f"Config directory not found for containerId: {sanitized_id}")
+        logger.error("Config directory not found for containerId: %s", sanitized_id)
+        client_config_cache.pop(sanitized_id, None)
         return None
 
+    # mtime zapisujemy przed odczytem, żeby zmiana w trakcie ładowania wymusiła kolejne przeładowanie
+    events_mtime_ns, settings_mtime_ns = get_config_mtimes(sanitized_id)
+
     loaded_events: List[Event] = []
 
     try:
         if not events_path.is_file():
-            logger.error(f"events.json not found for containerId: {sanitized_id}")
+            logger.error("events.json not found for containerId: %s", sanitized_id)
             raise FileNotFoundError
-        with open(events_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if not isinstance(data, list):
-                 raise ValueError("events.json should contain a list.")
-            for item in data:
-                try:
-                    event = Event(**item)
-                    loaded_events.append(event)
-                    logger.debug(f"Loaded event: {event.name} (Sender: {event.sender}, Threshold: {event.threshold})")
-                except Exception as e:
-                    logger.warning(f"Skipping invalid event item for {sanitized_id}: {item}. Error: {e}")
+        # msgspec dekoduje bezpośrednio z bajtów; odczyt pliku poza pętlą zdarzeń
+        raw_items = events_list_decoder.decode(await asyncio.to_thread(events_path.read_bytes))
+        for raw_item in raw_items:
+            try:
+                event = event_decoder.decode(raw_item)
+                loaded_events.append(event)
+                logger.debug("Loaded event: %s (Sender: %s, Threshold: %s)", event.name, event.sender, event.threshold)
+            except msgspec.DecodeError as e:
+                logger.warning("Skipping invalid event item for %s: %s. Error: %s", sanitized_id, bytes(raw_item).decode("utf-8", "replace"), e)
         if not loaded_events:
-            logger.warning(f"No valid events loaded from {events_path}")
+            logger.warning("No valid events loaded from %s", events_path)
 
-    except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
-        logger.error(f"Failed to load or parse {events_path}: {e}")
-        return None
+    except (FileNotFoundError, msgspec.DecodeError) as e:
+        logger.error("Failed to load or parse %s: %s", events_path, e)
+        return keep_previous_client_config(sanitized_id, previous_entry, events_mtime_ns, settings_mtime_ns)
     except Exception as e:
-        logger.error(f"Unexpected error loading events for {sanitized_id}: {e}", exc_info=True)
-        return None
+        logger.error("Unexpected error loading events for %s: %s", sanitized_id, e, exc_info=True)
+        return keep_previous_client_config(sanitized_id, previous_entry, events_mtime_ns, settings_mtime_ns)
 
+    # Przy uszkodzonym settings.json zostajemy przy poprzednich ustawieniach, a bez nich - przy domyślnych
+    fallback_settings = previous_entry[0].settings if previous_entry is not None else ClientSettings()
     loaded_settings = ClientSettings()
     try:
         if settings_path.is_file():
-            with open(settings_path, "r", encoding="utf-8") as f:
-                settings_data = json.load(f)
-                loaded_settings = ClientSettings(**settings_data)
+            loaded_settings = settings_decoder.decode(await asyncio.to_thread(settings_path.read_bytes))
         else:
-            logger.warning(f"settings.json not found for {sanitized_id}, using defaults.")
-    except (json.JSONDecodeError, ValueError) as e:
-         logger.error(f"Failed to load or parse {settings_path}: {e}. Using default settings.")
+            logger.warning("settings.json not found for %s, using defaults.", sanitized_id)
+    except msgspec.DecodeError as e:
+         logger.error("Failed to load or parse %s: %s. Using previous or default settings.", settings_path, e)
+         loaded_settings = fallback_settings
     except Exception as e:
-         logger.error(f"Unexpected error loading settings for {sanitized_id}: {e}. Using default settings.", exc_info=True)
+         logger.error("Unexpected error loading settings for %s: %s. Using previous or default settings.", sanitized_id, e, exc_info=True)
+         loaded_settings = fallback_settings
+
+    # Prekomputacja promptu i nazw eventów per nadawca (zamiast budowania przy każdym żądaniu)
+    # Tokenizer może przy pierwszym użyciu pobierać pliki, więc ładujemy go poza pętlą zdarzeń
+    encoding = await asyncio.to_thread(get_token_encoding)
+    events_blocks: Dict[str, str] = {}
+    prompt_prefixes: Dict[str, str] = {}
+    sender_event_names: Dict[str, frozenset[str]] = {}
+    logit_biases: Dict[str, Dict[str, int]] = {}
+    answer_max_tokens: Dict[str, int] = {}
+    for sender in ("human", "ai"):
+        sender_events = [event for event in loaded_events if event.sender == sender]
+        if sender_events:
+            if encoding is not None and MAX_PROMPT_TOKENS > 0:
+                sender_events = trim_examples_to_budget(sender_events, encoding, MAX_PROMPT_TOKENS)
+            events_blocks[sender] = build_events_block(sender_events)
+            prompt_prefixes[sender] = build_prompt_prefix(sender, events_blocks[sender])
+            sender_event_names[sender] = frozenset(event.name for event in sender_events)
+            logit_biases[sender] = build_logit_bias(sender_event_names[sender], encoding) if encoding else {}
+            answer_max_tokens[sender] = build_answer_max_tokens(sender_event_names[sender], encoding)
+
+    # Przy zduplikowanych nazwach wygrywa pierwszy event (jak przy dawnym liniowym wyszukiwaniu)
+    event_by_name: Dict[str, Event] = {}
+    for event in loaded_events:
+        event_by_name.setdefault(event.name, event)
 
     config = ClientConfig(
         events=loaded_events,
-        settings=loaded_settings
+        settings=loaded_settings,
+        events_blocks=events_blocks,
+        prompt_prefixes=prompt_prefixes,
+        sender_event_names=sender_event_names,
+        logit_biases=logit_biases,
+        answer_max_tokens=answer_max_tokens,
+        event_by_name=event_by_name,
+        allowed_domains_set=frozenset(domain.lower() for domain in loaded_settings.allowed_domains)
     )
-    client_config_cache[sanitized_id] = config
-    logger.info(f"Successfully loaded and cached config for {sanitized_id}.")
+    client_config_cache[sanitized_id] = (config, events_mtime_ns, settings_mtime_ns)
+    logger.info("Successfully loaded and cached config for %s.", sanitized_id)
     return config
 
 # --- Application Startup ---
@@ -272,7 +675,7 @@ async def startup_event():
     """Loguje informacje startowe, sprawdza klucze API i status LangSmith."""
     logger.info("Application starting up...")
     if not CONFIG_BASE_DIR.is_dir():
-        logger.warning(f"Base config directory '{CONFIG_BASE_DIR}' not found. Client configs cannot be loaded.")
+        logger.warning("Base config directory '%s' not found. Client configs cannot be loaded.", CONFIG_BASE_DIR)
     # Sprawdzenie klucza OpenAI
     if not openai_api_key:
         logger.error("CRITICAL: OPENAI_API_KEY is not set. Classification endpoint will fail.")
@@ -281,17 +684,48 @@ async def startup_event():
     # Sprawdzenie konfiguracji LangSmith
     if langsmith_tracing_enabled:
         if langsmith_api_key:
-            logger.info(f"LangSmith tracing is ENABLED. Project: '{langsmith_project}'. API Key found.")
+            logger.info("LangSmith tracing is ENABLED. Project: '%s'. API Key found.", langsmith_project)
         else:
             logger.error("CRITICAL: LangSmith tracing is ENABLED but LANGSMITH_API_KEY is not set.")
     else:
         logger.info("LangSmith tracing is DISABLED.")
+    # Start workera micro-batchingu klasyfikacji
+    global classification_queue, classification_batch_worker_task
+    if CLASSIFY_BATCH_MAX > 1:
+        classification_queue = asyncio.Queue()
+        classification_batch_worker_task = asyncio.create_task(classification_batch_worker(classification_queue))
+        logger.info("Classification micro-batching enabled (max batch: %s, window: %s ms).", CLASSIFY_BATCH_MAX, CLASSIFY_BATCH_WAIT_MS)
+    else:
+        logger.info("Classification micro-batching is DISABLED.")
+    if redis_client is not None:
+        logger.info("Message history is stored in Redis (shared between workers).")
+    elif int(os.getenv("WEB_CONCURRENCY") or "1") > 1:
+        logger.warning("WEB_CONCURRENCY=%s but REDIS_URL is not set: message history is kept per worker process, so sessions lose their previous-message context. Set REDIS_URL or run a single worker.", os.getenv("WEB_CONCURRENCY"))
+    else:
+        logger.info("Message history is stored in process memory. Set REDIS_URL when running multiple workers.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Zatrzymuje worker micro-batchingu i zamyka połączenia do OpenAI i Redisa."""
+    global classification_queue, classification_batch_worker_task
+    if classification_batch_worker_task:
+        classification_batch_worker_task.cancel()
+        try:
+            await classification_batch_worker_task
+        except asyncio.CancelledError:
+            pass
+    classification_queue = None
+    classification_batch_worker_task = None
+    await openai_http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 # --- Funkcja klasyfikacji OpenAI (z kontekstem poprzedniej wiadomości) ---
 async def classify_with_openai(
     text: str, 
     sender: Literal['human', 'ai'], 
-    available_events: List[Event],
+    container_id: str,
+    client_config: ClientConfig,
     previous_message_text: Optional[str] = None, # Dodano poprzednią wiadomość
     previous_message_sender: Optional[Literal['human', 'ai']] = None # Dodano nadawcę poprzedniej wiadomości
 ) -> str | None:
@@ -300,115 +734,232 @@ async def classify_with_openai(
         logger.error("OpenAI API key not configured. Cannot classify.")
         return None
 
-    # 1. Filtruj eventy pasujące do *aktualnego* nadawcy
-    sender_events = [event for event in available_events if event.sender == sender]
-    if not sender_events:
-        logger.warning(f"No events defined for sender '{sender}'. Cannot classify.")
+    # 1. Pobierz prekomputowany prompt i nazwy eventów dla *aktualnego* nadawcy
+    prompt_prefix = client_config.prompt_prefixes.get(sender)
+    allowed_event_names = client_config.sender_event_names.get(sender)
+    if not prompt_prefix or not allowed_event_names:
+        logger.warning("No events defined for sender '%s'. Cannot classify.", sender)
         return None
 
-    # 2. Zbuduj prompt dla LLM (z przykładami i kontekstem)
-    prompt_lines = [
-        f"Twoim zadaniem jest sklasyfikowanie wiadomości od '{sender}' na podstawie zdefiniowanych eventów.",
-        "Odpowiedz TYLKO nazwą eventu, który najlepiej pasuje do OSTATNIEJ wiadomości, lub 'None', jeśli żaden nie pasuje.",
-        "Nie dodawaj żadnych wyjaśnień ani dodatkowego tekstu.",
-        "Użyj poprzedniej wiadomości jako kontekstu, jeśli to pomoże.",
-        "",
-        f"Dostępne eventy dla '{sender}':",
-    ]
-    for event in sender_events:
-        prompt_lines.append(f"- Nazwa: {event.name}")
-        prompt_lines.append(f"  Opis: {event.description}")
-        if event.examples:
-            formatted_examples = "\n".join([f"    - {ex}" for ex in event.examples])
-            prompt_lines.append(f"  Przykłady:\n{formatted_examples}")
-    prompt_lines.append("")
-    
-    # --- Dodanie kontekstu poprzedniej wiadomości --- START
+    # 2. Zbuduj część dynamiczną (kontekst + aktualna wiadomość) - współdzieloną z promptem batchowym.
+    # Pojedyncze f-stringi zamiast listy + join: stały prefix jest gotowy, doklejamy tylko ogon.
+    context_block = ""
     if previous_message_text and previous_message_sender:
-        prompt_lines.append(f"Poprzednia wiadomość w konwersacji ({previous_message_sender}):")
-        prompt_lines.append("```")
-        prompt_lines.append(previous_message_text)
-        prompt_lines.append("```")
-        prompt_lines.append("")
-    # --- Dodanie kontekstu poprzedniej wiadomości --- END
-    
-    prompt_lines.append(f"Wiadomość do sklasyfikowania ({sender}):")
-    prompt_lines.append("```")
-    prompt_lines.append(text)
-    prompt_lines.append("```")
-    prompt_lines.append("")
-    prompt_lines.append("Najlepiej pasujący event (lub None):")
+        context_block = f"Poprzednia wiadomość w konwersacji ({previous_message_sender}):\n```\n{previous_message_text}\n```\n\n"
+    message_block = f"{context_block}Wiadomość do sklasyfikowania ({sender}):\n```\n{text}\n```"
+
+    system_prompt = f"{prompt_prefix}\n{message_block}\n\nNajlepiej pasujący event (JSON):"
+    logger.debug("--- OpenAI Prompt ---\n%s\n--------------------", system_prompt)
+
+    # 3. Identyczne równoległe zapytania współdzielą jedno wywołanie OpenAI - tylko w obrębie tego samego klienta i nadawcy
+    prompt_hash = hashlib.blake2b(system_prompt.encode("utf-8"), digest_size=16).hexdigest()
+    prompt_key = f"{container_id}:{sender}:{prompt_hash}"
+    pending_call = inflight_classifications.get(prompt_key)
+    if pending_call is not None:
+        logger.debug("Joining in-flight OpenAI classification for prompt key: %s", prompt_key)
+    else:
+        pending_call = asyncio.ensure_future(submit_classification(PendingClassification(
+            container_id=container_id,
+            sender=sender,
+            prompt_prefix=prompt_prefix,
+            events_block=client_config.events_blocks[sender],
+            message_block=message_block,
+            system_prompt=system_prompt,
+            allowed_event_names=allowed_event_names,
+            logit_bias=client_config.logit_biases.get(sender, {}),
+            max_tokens=client_config.answer_max_tokens.get(sender, DEFAULT_ANSWER_MAX_TOKENS),
+        )))
+        inflight_classifications[prompt_key] = pending_call
+        pending_call.add_done_callback(lambda _: inflight_classifications.pop(prompt_key, None))
+    # shield: anulowanie jednego z oczekujących nie przerywa wywołania współdzielonego z innymi
+    return await asyncio.shield(pending_call)
+
+async def submit_classification(item: PendingClassification) -> str | None:
+    """Kieruje klasyfikację do micro-batchingu, a gdy jest wyłączony - bezpośrednio do OpenAI."""
+    if CLASSIFY_BATCH_MAX <= 1 or classification_queue is None:
+        return await request_openai_classification(item)
+    future = asyncio.get_running_loop().create_future()
+    await classification_queue.put((item, future))
+    return await future
+
+async def classification_batch_worker(queue: asyncio.Queue) -> None:
+    """Zbiera oczekujące klasyfikacje w okna (do CLASSIFY_BATCH_MAX sztuk / CLASSIFY_BATCH_WAIT_MS) i wysyła je grupami."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + CLASSIFY_BATCH_WAIT_MS / 1000
+        while len(batch) < CLASSIFY_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Wspólny prompt mogą dzielić tylko wiadomości tego samego klienta i nadawcy -
+        # identyczny prefix nie wystarcza, bo wiadomości różnych klientów nie mogą trafić do jednego promptu
+        groups: Dict[Tuple[str, str], List[Tuple[PendingClassification, asyncio.Future]]] = {}
+        for item, future in batch:
+            groups.setdefault((item.container_id, item.sender), []).append((item, future))
+        for group in groups.values():
+            task = asyncio.create_task(run_classification_group(group))
+            classification_batch_tasks.add(task)
+            task.add_done_callback(classification_batch_tasks.discard)
+
+async def run_classification_group(group: List[Tuple[PendingClassification, asyncio.Future]]) -> None:
+    """Klasyfikuje grupę wiadomości (jednym wywołaniem, jeśli jest ich kilka) i rozsyła wyniki do oczekujących."""
+    try:
+        if len(group) == 1:
+            item, _ = group[0]
+            results = [await request_openai_classification(item)]
+        else:
+            results = await request_openai_batch_classification([item for item, _ in group])
+    except Exception as e:
+        logger.error("Error while classifying a group of %s messages: %s", len(group), e, exc_info=True)
+        for _, future in group:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), result in zip(group, results):
+        if not future.done():
+            future.set_result(result)
+
+async def request_openai_batch_classification(items: List[PendingClassification]) -> List[str | None]:
+    """Klasyfikuje kilka wiadomości jednym wywołaniem OpenAI; przy niepoprawnej odpowiedzi wraca do pojedynczych wywołań."""
+    first = items[0]
+    batch_prompt = build_batch_prompt(first.sender, first.events_block, [item.message_block for item in items])
+    logger.debug("--- OpenAI Batch Prompt (%s messages) ---\n%s\n--------------------", len(items), batch_prompt)
+    max_tokens = (first.max_tokens + BATCH_ANSWER_ITEM_OVERHEAD_TOKENS) * len(items) + BATCH_ANSWER_JSON_OVERHEAD_TOKENS
 
-    system_prompt = "\n".join(prompt_lines)
-    logger.debug(f"--- OpenAI Prompt ---\n{system_prompt}\n--------------------")
+    try:
+        response = await aclient.chat.completions.create(
+            messages=[{"role": "system", "content": batch_prompt}],
+            max_tokens=max_tokens,
+            logit_bias=first.logit_bias,
+            **OPENAI_CHAT_BASE_KWARGS
+        )
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            raise ValueError(f"OpenAI response truncated at max_tokens={max_tokens}")
+        result_text = choice.message.content.strip()
+        logger.info("OpenAI raw batch response (%s messages): '%s'", len(items), result_text)
+
+        parsed = orjson.loads(result_text)
+        results_list = parsed.get("results") if isinstance(parsed, dict) else None
+        if not isinstance(results_list, list):
+            raise ValueError("batch response has no 'results' list")
+        events_by_id = {
+            entry.get("id"): entry.get("event")
+            for entry in results_list
+            if isinstance(entry, dict)
+        }
+        if any(message_id not in events_by_id for message_id in range(1, len(items) + 1)):
+            raise ValueError("batch response is missing some message ids")
+    except Exception as e:
+        logger.warning("Batch classification of %s messages failed (%s). Falling back to single calls.", len(items), e)
+        return list(await asyncio.gather(*(
+            request_openai_classification(item) for item in items
+        )))
+
+    results: List[str | None] = []
+    for message_id, item in enumerate(items, start=1):
+        event_name = events_by_id[message_id]
+        if event_name is None or event_name == "None":
+            results.append(None)
+        elif isinstance(event_name, str) and event_name in item.allowed_event_names:
+            results.append(event_name)
+        else:
+            logger.warning("OpenAI batch returned an unexpected event name: '%s'. Allowed: %s. Returning None.", event_name, sorted(item.allowed_event_names))
+            results.append(None)
+    return results
 
+async def request_openai_classification(item: PendingClassification) -> str | None:
+    """Wysyła prompt do OpenAI (JSON mode) i waliduje zwróconą nazwę eventu."""
     try:
         response = await aclient.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role": "system", "content": system_prompt}],
-            temperature=0,
-            max_tokens=50
+            messages=[{"role": "system", "content": item.system_prompt}],
+            max_tokens=item.max_tokens,
+            logit_bias=item.logit_bias,
+            **OPENAI_CHAT_BASE_KWARGS
         )
-        
-        result_text = response.choices[0].message.content.strip()
-        logger.info(f"OpenAI raw response: '{result_text}'")
 
-        if result_text == "None":
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            logger.warning("OpenAI response truncated at max_tokens=%s: '%s'. Returning None.", item.max_tokens, choice.message.content)
+            return None
+        result_text = choice.message.content.strip()
+        logger.info("OpenAI raw response: '%s'", result_text)
+
+        parsed = orjson.loads(result_text)
+        event_name = parsed.get("event") if isinstance(parsed, dict) else None
+        if event_name is None or event_name == "None":
             return None
-        if any(event.name == result_text for event in sender_events):
-            return result_text
+        if isinstance(event_name, str) and event_name in item.allowed_event_names:
+            return event_name
         else:
-            logger.warning(f"OpenAI returned an unexpected event name: '{result_text}'. Allowed: {[e.name for e in sender_events]}. Returning None.")
+            logger.warning("OpenAI returned an unexpected event name: '%s'. Allowed: %s. Returning None.", event_name, sorted(item.allowed_event_names))
             return None
 
     except Exception as e:
-        logger.error(f"Error calling OpenAI API: {e}", exc_info=True)
+        logger.error("Error calling OpenAI API: %s", e, exc_info=True)
         return None
 
 # --- API Endpoints ---
 
-@app.post("/classify", response_model=ClassifyResponse)
-async def classify_message(request_body: ClassifyRequest, request: Request):
+# Ciała żądań walidujemy ręcznie (parse_*_request), więc schematy przekazujemy do OpenAPI jawnie
+def _json_body_schema(model: type[BaseModel]) -> Dict[str, Any]:
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": model.model_json_schema()}}}}
+
+@app.post(
+    "/classify",
+    openapi_extra=_json_body_schema(ClassifyRequest),
+)
+async def classify_message(request: Request) -> ClassifyResponse:
     """
     Klasyfikuje tekst wejściowy używając API OpenAI, po walidacji domeny.
     """
+    request_body = parse_classify_request(await request.body())
     container_id = request_body.containerId
     session_id = request_body.sessionId
     history_key = get_history_key(container_id, session_id)
     
-    logger.info(f"Received classify request for containerId='{container_id}', sessionId='{session_id}', sender='{request_body.sender}', text='{request_body.text[:50]}...'")
-    client_config = load_client_config(container_id)
+    logger.info("Received classify request for containerId='%s', sessionId='%s', sender='%s', text='%.50s...'", container_id, session_id, request_body.sender, request_body.text)
+    # Cache hit obsługujemy synchronicznie; await tylko przy faktycznym ładowaniu z dysku
+    client_config = get_cached_client_config(container_id)
+    if client_config is None:
+        client_config = await load_client_config(container_id)
     if not client_config:
-        logger.error(f"Configuration not found or invalid for containerId: {container_id}")
+        logger.error("Configuration not found or invalid for containerId: %s", container_id)
         raise HTTPException(status_code=400, detail=f"Invalid or missing configuration for container ID: {container_id}")
     origin = request.headers.get("origin")
     origin_domain = None
     if origin:
         try:
-            parsed_origin = urlparse(origin)
-            origin_domain = parsed_origin.hostname
+            origin_domain = parse_origin_hostname(origin)
         except Exception:
-            logger.warning(f"Could not parse Origin header: {origin}")
-    logger.debug(f"Request origin header: {origin}, parsed domain: {origin_domain}")
+            logger.warning("Could not parse Origin header: %s", origin)
+    logger.debug("Request origin header: %s, parsed domain: %s", origin, origin_domain)
     allowed = False
-    if client_config.settings.allowed_domains:
-        if origin_domain and origin_domain in client_config.settings.allowed_domains:
+    if client_config.allowed_domains_set:
+        if origin_domain and origin_domain in client_config.allowed_domains_set:
              allowed = True
     elif not origin_domain:
         allowed = True
     if not allowed:
-        logger.warning(f"Origin '{origin_domain or origin}' is not in allowed domains for containerId '{container_id}': {client_config.settings.allowed_domains}")
+        logger.warning("Origin '%s' is not in allowed domains for containerId '%s': %s", origin_domain or origin, container_id, client_config.settings.allowed_domains)
         raise HTTPException(status_code=403, detail="Origin not allowed")
-    logger.debug(f"Origin '{origin_domain}' validated successfully for containerId '{container_id}'")
+    logger.debug("Origin '%s' validated successfully for containerId '%s'", origin_domain, container_id)
 
     # 3. Pobierz poprzednią wiadomość z historii dla tego klucza (containerId+sessionId)
     prev_text: Optional[str] = None
     prev_sender: Optional[Literal["human", "ai"]] = None
-    if history_key in message_history:
-        prev_text, prev_sender = message_history[history_key]
-        logger.debug(f"Found previous message for context (Key: {history_key}, Sender: {prev_sender}): {prev_text[:50]}...")
+    previous_message = await get_previous_message(history_key)
+    if previous_message is not None:
+        prev_text, prev_sender = previous_message
+        logger.debug("Found previous message for context (Key: %s, Sender: %s): %.50s...", history_key, prev_sender, prev_text)
     else:
-        logger.debug(f"No previous message found in history for this key: {history_key}")
+        logger.debug("No previous message found in history for this key: %s", history_key)
 
     # 4. Klasyfikacja za pomocą OpenAI (z kontekstem)
     classified_event_name: str | None = None
@@ -416,46 +967,47 @@ async def classify_message(request_body: ClassifyRequest, request: Request):
         classified_event_name = await classify_with_openai(
             text=request_body.text,
             sender=request_body.sender,
-            available_events=client_config.events,
+            container_id=container_id,
+            client_config=client_config,
             previous_message_text=prev_text,       # Przekaż poprzednią wiadomość
             previous_message_sender=prev_sender      # Przekaż nadawcę poprzedniej wiadomości
         )
-        logger.info(f"OpenAI classification result: '{classified_event_name}'")
+        logger.info("OpenAI classification result: '%s'", classified_event_name)
 
     except Exception as e:
-        logger.error(f"Exception during OpenAI classification call for {container_id}: {e}")
+        logger.error("Exception during OpenAI classification call for %s: %s", container_id, e)
         raise HTTPException(status_code=500, detail="Error during classification process.")
 
     # 5. Zaktualizuj historię ostatnią wiadomością, używając klucza zawierającego sessionId
-    message_history[history_key] = (request_body.text, request_body.sender)
-    logger.debug(f"Updated message history for key: {history_key}")
+    await save_message(history_key, request_body.text, request_body.sender)
+    logger.debug("Updated message history for key: %s", history_key)
 
     # 6. Zastosuj Próg (logika bez zmian, tylko informacyjnie)
     should_push = classified_event_name is not None
-    final_event_obj = next((evt for evt in client_config.events if evt.name == classified_event_name), None)
-    threshold = DEFAULT_THRESHOLD
-    if final_event_obj and final_event_obj.threshold is not None:
-        threshold = final_event_obj.threshold
-    logger.info(f"Event classified: '{classified_event_name}'. Threshold (informational): {threshold:.2f}. Should push: {should_push}")
-
-    # 7. Zwróć wynik (bez zmian)
-    return ClassifyResponse(
+    threshold = resolve_event_threshold(client_config.event_by_name, classified_event_name, DEFAULT_THRESHOLD)
+    logger.info("Event classified: '%s'. Threshold (informational): %.2f. Should push: %s", classified_event_name, threshold, should_push)
+
+    # 7. Zwróć wynik - model_construct pomija walidację, a FastAPI serializuje model wprost do bajtów JSON (Pydantic)
+    return ClassifyResponse.model_construct(
         event=classified_event_name,
         confidence=None,
         shouldPush=should_push,
         sender=request_body.sender
     )
 
-@app.post("/push", response_model=PushResponse)
-async def push_event(request: PushRequest):
+@app.post(
+    "/push",
+    openapi_extra=_json_body_schema(PushRequest),
+)
+async def push_event(request: Request) -> PushResponse:
     """Placeholder endpoint to acknowledge event push."""
-    logger.info(f"Received push request: Event='{request.event}', Sender='{request.sender}', Properties={request.properties}")
-    push_log.append(request)
-    response_data = PushResponse(status="received", event_data=request)
-    return response_data
+    push_request = parse_push_request(await request.body())
+    logger.info("Received push request: Event='%s', Sender='%s', Properties=%s", push_request.event, push_request.sender, push_request.properties)
+    push_log.append(push_request)
+    return PushResponse.model_construct(status="received", event_data=push_request)
 
 @app.get("/health", status_code=200)
-async def health_check():
+async def health_check() -> HealthResponse:
     """Simple health check endpoint."""
     openai_status = "available" if aclient.api_key else "unavailable (OpenAI API key missing)"
     langsmith_status = "unknown"
@@ -463,12 +1015,12 @@ async def health_check():
         langsmith_status = "enabled (API key found)" if langsmith_api_key else "enabled (API key missing)"
     else:
         langsmith_status = "disabled"
-    return {
-        "status": "ok",
-        "openai_model_status": openai_status,
-        "langsmith_tracing_status": langsmith_status,
-        "langsmith_project": langsmith_project if langsmith_tracing_enabled else None
-    }
+    return HealthResponse.model_construct(
+        status="ok",
+        openai_model_status=openai_status,
+        langsmith_tracing_status=langsmith_status,
+        langsmith_project=langsmith_project if langsmith_tracing_enabled else None
+    )
 
 # --- Add instructions for running ---
 # To run the server:
@@ -0,0 +1,10 @@
+# Kompilacja helperów gorącej ścieżki (_hot.py) do rozszerzenia C za pomocą Cythona.
+# Użycie: pip install cython setuptools && python setup.py build_ext --inplace
+# Bez kompilacji aplikacja działa na zwykłym _hot.py.
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="llmaniac-hot",
+    ext_modules=cythonize(["_hot.py"], language_level=3),
+)